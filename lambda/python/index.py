@@ -1,99 +1,119 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import functools
 import json
 import os
+import secrets
+import time
 import boto3
 from datetime import datetime
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Get environment variables
 customers_table_name = os.environ.get("CUSTOMERS_TABLE")
 tradesperson_table_name = os.environ.get("TRADESPERSON_TABLE")
 bookings_table_name = os.environ.get("BOOKINGS_TABLE")
-
-# Initialize DynamoDB resources
-dynamodb = boto3.resource("dynamodb")
+log_level = os.environ.get("LOG_LEVEL", "INFO")
+
+# Initialize DynamoDB resources once per container so warm invocations reuse
+# pooled keep-alive connections
+dynamodb_config = Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+)
+dynamodb = boto3.resource("dynamodb", config=dynamodb_config)
+# Low-level client for writes with fixed string schemas, which skips the
+# resource layer's type marshalling
+dynamodb_client = boto3.client("dynamodb", config=dynamodb_config)
 customers_table = dynamodb.Table(customers_table_name)
 tradesperson_table = dynamodb.Table(tradesperson_table_name)
 bookings_table = dynamodb.Table(bookings_table_name)
 
+# Tradesperson records change rarely, so cache them per warm container for this long
+TRADESPERSON_CACHE_TTL_SECONDS = 300
+
+# Attempts at generating a unique booking ID before giving up
+BOOKING_ID_ATTEMPTS = 3
+
+# Map each API path to its operation, called with (customer_id, event). Only
+# operations that take parameters parse them out of the request body.
+ROUTES = {
+    "/get-current-datetime": lambda customer_id, event: get_current_date_time(),
+    "/get-customer-details": lambda customer_id, event: get_customer_details(
+        customer_id
+    ),
+    "/register-customer": lambda customer_id, event: register_customer(
+        customer_id, _get_post_params(event)
+    ),
+    "/search-trades-persons": lambda customer_id, event: search_trades_persons(
+        _get_post_params(event)
+    ),
+    "/check-availability": lambda customer_id, event: check_availability(
+        _get_post_params(event)
+    ),
+    "/create-booking": lambda customer_id, event: create_booking(
+        customer_id, _get_post_params(event)
+    ),
+    "/get-latest-booking": lambda customer_id, event: get_latest_booking(customer_id),
+    "/cancel-booking": lambda customer_id, event: cancel_booking(
+        _get_post_params(event)
+    ),
+    "/update-booking": lambda customer_id, event: update_booking(
+        customer_id, _get_post_params(event)
+    ),
+}
+
+# Extract the customer profile from a response body for operations that return one
+PROMPT_SESSION_ATTRIBUTE_HOOKS = {
+    "/get-customer-details": lambda body: body.get("customer"),
+    "/register-customer": lambda body: body,
+}
+
 
 def handler(event, context):
     """
     Main handler for the plumbing assistant Lambda function
     This single Lambda handles all operations for the Bedrock agent
     """
-    print(f"Event received: {json.dumps(event, default=str)}")
+    # Serializing the full event is only worth paying for when debugging
+    if log_level.upper() == "DEBUG":
+        print(f"Event received: {json.dumps(event)}")
+
+    # Session attributes are echoed back on both success and error responses
+    session_attributes = event.get("sessionAttributes", {})
+    prompt_session_attributes = event.get("promptSessionAttributes", {})
 
     try:
         # Extract the API operation from the event
         api_path = event.get("apiPath")
 
         # Get customerId from session attributes if available
-        customer_id = event.get("sessionAttributes", {}).get("phone-number", "00000")
+        customer_id = session_attributes.get("phone-number", "00000")
 
         # Initialize response variables
         response_body = {}
         http_status_code = 200
 
-        # Handle POST requests with request bodies
-        post_parameters = []
-        if event.get("requestBody") and event["requestBody"].get("content", {}).get(
-            "application/json", {}
-        ).get("properties"):
-            post_parameters = event["requestBody"]["content"]["application/json"][
-                "properties"
-            ]
-
-        post_params = {prop["name"]: prop["value"] for prop in post_parameters}
-
-        print(f"Processing {api_path} operation")
+        print(f"Processing {api_path} operation for customer {customer_id}")
 
         additional_prompt_session_attributes = {}
 
         # Route to the appropriate handler based on the operation
-        if api_path == "/get-current-datetime":
-            response_body = get_current_date_time()
-            http_status_code = response_body.get("statusCode", 200)
-        elif api_path == "/get-customer-details":
-            response_body = get_customer_details(customer_id)
-            http_status_code = response_body.get("statusCode", 200)
-            if http_status_code == 200 and response_body["body"]["customer"]:
-                additional_prompt_session_attributes["customerName"] = response_body[
-                    "body"
-                ]["customer"]["name"]
-                additional_prompt_session_attributes["customerCity"] = response_body[
-                    "body"
-                ]["customer"]["city"]
-        elif api_path == "/register-customer":
-            response_body = register_customer(customer_id, post_params)
-            additional_prompt_session_attributes["customerName"] = response_body[
-                "body"
-            ]["name"]
-            additional_prompt_session_attributes["customerCity"] = response_body[
-                "body"
-            ]["city"]
-            http_status_code = response_body.get("statusCode", 200)
-        elif api_path == "/search-trades-persons":
-            response_body = search_trades_persons(post_params)
-            http_status_code = response_body.get("statusCode", 200)
-        elif api_path == "/check-availability":
-            response_body = check_availability(post_params)
-            http_status_code = response_body.get("statusCode", 200)
-        elif api_path == "/create-booking":
-            response_body = create_booking(customer_id, post_params)
-            http_status_code = response_body.get("statusCode", 200)
-        elif api_path == "/get-latest-booking":
-            response_body = get_latest_booking(customer_id)
-            http_status_code = response_body.get("statusCode", 200)
-        elif api_path == "/cancel-booking":
-            response_body = cancel_booking(post_params)
-            http_status_code = response_body.get("statusCode", 200)
-        elif api_path == "/update-booking":
-            response_body = update_booking(customer_id, post_params)
+        route = ROUTES.get(api_path)
+        if route:
+            response_body = route(customer_id, event)
             http_status_code = response_body.get("statusCode", 200)
+
+            # Expose the customer's profile to the agent once it is known
+            get_customer = PROMPT_SESSION_ATTRIBUTE_HOOKS.get(api_path)
+            customer = get_customer(response_body["body"]) if get_customer else None
+            if customer:
+                additional_prompt_session_attributes["customerName"] = customer["name"]
+                additional_prompt_session_attributes["customerCity"] = customer["city"]
         else:
             response_body = {"error": f"Unsupported operation: {api_path}"}
             http_status_code = 400
@@ -110,10 +130,6 @@ def handler(event, context):
             "responseBody": response_body_formatted,
         }
 
-        session_attributes = event.get("sessionAttributes", {})
-
-        prompt_session_attributes = event.get("promptSessionAttributes", {})
-
         prompt_session_attributes.update({"customerId": customer_id})
         prompt_session_attributes.update({"customerPhoneNumber": customer_id})
         prompt_session_attributes.update(additional_prompt_session_attributes)
@@ -142,9 +158,6 @@ def handler(event, context):
             "responseBody": response_body_formatted,
         }
 
-        session_attributes = event.get("sessionAttributes", {})
-        prompt_session_attributes = event.get("promptSessionAttributes", {})
-
         api_response = {
             "messageVersion": "1.0",
             "response": action_response,
@@ -155,6 +168,21 @@ def handler(event, context):
         return api_response
 
 
+def _get_post_params(event):
+    """
+    Extract the parameters of a POST request body as a name/value dict
+    """
+    post_parameters = []
+    if event.get("requestBody") and event["requestBody"].get("content", {}).get(
+        "application/json", {}
+    ).get("properties"):
+        post_parameters = event["requestBody"]["content"]["application/json"][
+            "properties"
+        ]
+
+    return {prop["name"]: prop["value"] for prop in post_parameters}
+
+
 def search_trades_persons(params):
     """
     Search for tradespeople based on trade, location, and rating
@@ -167,6 +195,8 @@ def search_trades_persons(params):
         IndexName="TradeIndex",
         KeyConditionExpression=Key("trade").eq(trade.lower())
         & Key("city").eq(city.lower()),
+        ProjectionExpression="tradesPersonId, #n, trade, hourlyRate, city, contactNumber",
+        ExpressionAttributeNames={"#n": "name"},
     )
 
     # Format the response
@@ -196,30 +226,75 @@ def check_availability(params):
     start_slot = params.get("startSlot")
     end_slot = params.get("endSlot")
 
-    start_hour = datetime.fromisoformat(start_slot.replace("Z", "+00:00")).hour
-    end_hour = datetime.fromisoformat(end_slot.replace("Z", "+00:00")).hour
-
-    # Query DynamoDB for existing bookings in the time range
+    requested_start = datetime.fromisoformat(start_slot)
+    start_date = requested_start.replace(minute=0, second=0, microsecond=0)
+    start_hour = start_date.hour
+    # Only offer hourly slots inside the requested range, which is also the
+    # range the bookings query covers
+    if start_date < requested_start:
+        start_hour += 1
+    requested_end = datetime.fromisoformat(end_slot)
+    end_hour = requested_end.hour
+
+    # Query DynamoDB for existing bookings in the time range, using the same ISO
+    # format that bookings are stored in so the string comparison lines up
     response = bookings_table.query(
         IndexName="TradesPersonIdIndex",
         KeyConditionExpression=Key("tradesPersonId").eq(tradesperson_id)
-        & Key("slot").between(start_slot, end_slot),
+        & Key("slot").between(requested_start.isoformat(), requested_end.isoformat()),
     )
 
-    booked_slots = [item.get("slot") for item in response.get("Items", [])]
+    booked_slots = {item.get("slot") for item in response.get("Items", [])}
 
     # Generate available time slots
     available_time_slots = []
     for i in range(start_hour, end_hour):
-        temp_date = datetime.fromisoformat(start_slot.replace("Z", "+00:00"))
-        temp_date = temp_date.replace(hour=i)
-        slot = temp_date.isoformat()
+        slot = start_date.replace(hour=i).isoformat()
         if slot not in booked_slots:
             available_time_slots.append(slot)
 
     return {"statusCode": 200, "body": {"availableTimeSlots": available_time_slots}}
 
 
+def _get_tradesperson(tradesperson_id):
+    """
+    Get tradesperson details, cached for up to TRADESPERSON_CACHE_TTL_SECONDS
+    """
+    ttl_bucket = int(time.time() // TRADESPERSON_CACHE_TTL_SECONDS)
+    try:
+        return _get_tradesperson_cached(tradesperson_id, ttl_bucket)
+    except KeyError:
+        return {}
+
+
+@functools.lru_cache(maxsize=256)
+def _get_tradesperson_cached(tradesperson_id, ttl_bucket):
+    """
+    Get tradesperson details, raising KeyError if not found so that misses are not
+    cached (lru_cache does not cache exceptions)
+    """
+    response = tradesperson_table.get_item(Key={"tradesPersonId": tradesperson_id})
+    if "Item" not in response:
+        raise KeyError(tradesperson_id)
+    return response["Item"]
+
+
+def _string_item(attributes):
+    """
+    Build a low-level DynamoDB item from string attributes, omitting missing values
+    """
+    return {
+        name: {"S": value} for name, value in attributes.items() if value is not None
+    }
+
+
+def _normalize_slot(slot):
+    """
+    Validate a slot and normalize it to the ISO format stored in the bookings table
+    """
+    return datetime.fromisoformat(slot).isoformat()
+
+
 def create_booking(customer_id, params):
     """
     Create a new booking
@@ -228,26 +303,47 @@ def create_booking(customer_id, params):
     slot = params.get("slot")
     description = params.get("description")
 
-    # Generate a booking ID
-    booking_id = "b" + str(int(datetime.now().timestamp()))[-5:]
-
-    # Create the booking
-    booking = {
-        "bookingId": booking_id,
-        "tradesPersonId": tradesperson_id,
-        "customerId": customer_id,
-        "slot": datetime.fromisoformat(slot.replace("Z", "+00:00")).isoformat(),
-        "description": description,
-    }
+    if not tradesperson_id or not slot:
+        return {
+            "statusCode": 400,
+            "body": {"error": "tradesPersonId and slot are required"},
+        }
 
-    # Save the booking to DynamoDB
-    bookings_table.put_item(Item=booking)
+    # Get tradesperson details to store on the booking and include in the confirmation
+    tradesperson_details = _get_tradesperson(tradesperson_id)
 
-    # Get tradesperson details to include in the confirmation
-    tradesperson_response = tradesperson_table.get_item(
-        Key={"tradesPersonId": tradesperson_id}
+    # Create the booking
+    # The tradesperson's name and trade are denormalized onto the booking so reads
+    # need no second lookup; they are left off if the tradesperson lacks them
+    booking = _string_item(
+        {
+            "tradesPersonId": tradesperson_id,
+            "customerId": customer_id,
+            "slot": _normalize_slot(slot),
+            "description": description,
+            "tradesPersonName": tradesperson_details.get("name"),
+            "tradesPersonTrade": tradesperson_details.get("trade"),
+        }
     )
-    tradesperson_details = tradesperson_response.get("Item", {})
+
+    # Save the booking to DynamoDB under a random ID, refusing to overwrite an
+    # existing booking and retrying with a fresh ID on the rare collision
+    for attempt in range(BOOKING_ID_ATTEMPTS):
+        booking_id = "b" + secrets.token_hex(4)
+        booking["bookingId"] = {"S": booking_id}
+        try:
+            dynamodb_client.put_item(
+                TableName=bookings_table_name,
+                Item=booking,
+                ConditionExpression="attribute_not_exists(bookingId)",
+            )
+            break
+        except ClientError as e:
+            if (
+                e.response["Error"]["Code"] != "ConditionalCheckFailedException"
+                or attempt == BOOKING_ID_ATTEMPTS - 1
+            ):
+                raise
 
     return {
         "statusCode": 200,
@@ -268,8 +364,9 @@ def register_customer(customer_id, params):
     name = params.get("name")
     city = params.get("city")
 
-    customers_table.put_item(
-        Item={"customerId": customer_id, "name": name, "city": city}
+    dynamodb_client.put_item(
+        TableName=customers_table_name,
+        Item=_string_item({"customerId": customer_id, "name": name, "city": city}),
     )
 
     return {
@@ -301,6 +398,12 @@ def get_latest_booking(customer_id):
     response = bookings_table.query(
         IndexName="CustomerIdIndex",
         KeyConditionExpression=Key("customerId").eq(customer_id),
+        ProjectionExpression="bookingId, tradesPersonId, tradesPersonName, "
+        "tradesPersonTrade, slot, description",
+        # CustomerIdIndex is sorted by slot, so the first item in descending
+        # order is the latest booking
+        ScanIndexForward=False,
+        Limit=1,
     )
 
     if not response.get("Items"):
@@ -311,16 +414,19 @@ def get_latest_booking(customer_id):
 
     item = response["Items"][0]
 
-    # Get tradesperson details for the booking
-    tradesperson_response = tradesperson_table.get_item(
-        Key={"tradesPersonId": item.get("tradesPersonId")}
-    )
-    tradesperson_details = tradesperson_response.get("Item", {})
+    # Bookings store the tradesperson's details; older ones need a lookup
+    if "tradesPersonName" in item:
+        tradesperson_details = {
+            "name": item["tradesPersonName"],
+            "trade": item.get("tradesPersonTrade", "Unknown"),
+        }
+    else:
+        tradesperson_details = _get_tradesperson(item.get("tradesPersonId"))
 
     # Format the date for better readability
-    booking_date = datetime.fromisoformat(
-        item.get("slot").replace("Z", "+00:00")
-    ).strftime("%Y-%m-%d %H:%M:%S")
+    booking_date = datetime.fromisoformat(item.get("slot")).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
 
     enhanced_booking = {
         "bookingId": item.get("bookingId"),
@@ -339,29 +445,21 @@ def cancel_booking(params):
     """
     booking_id = params.get("bookingId")
 
-    # Get the existing booking first to return its details
-    booking_response = bookings_table.get_item(Key={"bookingId": booking_id})
+    # Delete the booking, returning its previous attributes for the confirmation
+    delete_response = bookings_table.delete_item(
+        Key={"bookingId": booking_id}, ReturnValues="ALL_OLD"
+    )
 
-    if "Item" not in booking_response:
+    if "Attributes" not in delete_response:
         return {"statusCode": 404, "body": {"error": "Booking not found"}}
 
-    booking = booking_response["Item"]
-
-    # Get tradesperson details
-    tradesperson_response = tradesperson_table.get_item(
-        Key={"tradesPersonId": booking.get("tradesPersonId")}
-    )
-    tradesperson_details = tradesperson_response.get("Item", {})
-
-    # Delete the booking
-    bookings_table.delete_item(Key={"bookingId": booking_id})
+    booking = delete_response["Attributes"]
 
     return {
         "statusCode": 200,
         "body": {
             "message": "Booking cancelled successfully",
             **booking,
-            **tradesperson_details,
             "status": "CANCELLED",
         },
     }
@@ -390,27 +488,27 @@ def update_booking(customer_id, params):
         }
 
     # Update the booking with the new slot
-    new_slot = datetime.fromisoformat(slot.replace("Z", "+00:00")).isoformat()
+    new_slot = _normalize_slot(slot)
 
     bookings_table.update_item(
         Key={"bookingId": booking_id},
         UpdateExpression="set slot = :slot",
         ExpressionAttributeValues={":slot": new_slot},
-        ReturnValues="ALL_NEW",
     )
 
-    # Get tradesperson details to include in the confirmation
-    tradesperson_response = tradesperson_table.get_item(
-        Key={"tradesPersonId": booking.get("tradesPersonId")}
-    )
-    tradesperson_details = tradesperson_response.get("Item", {})
+    # Bookings store the tradesperson's name; older ones need a lookup
+    if "tradesPersonName" in booking:
+        tradesperson_name = booking["tradesPersonName"]
+    else:
+        tradesperson_details = _get_tradesperson(booking.get("tradesPersonId"))
+        tradesperson_name = tradesperson_details.get("name", "Unknown")
 
     return {
         "statusCode": 200,
         "body": {
             "message": "Booking updated successfully",
             "bookingId": booking_id,
-            "tradesPersonName": tradesperson_details.get("name", "Unknown"),
+            "tradesPersonName": tradesperson_name,
             "oldSlot": booking.get("slot"),
             "newSlot": new_slot,
             "description": booking.get("description"),
@@ -65,6 +65,7 @@ export class BookingAgentStack extends cdk.NestedStack {
         CUSTOMERS_TABLE: customersTable.tableName,
         TRADESPERSON_TABLE: tradesPersonsTable.tableName,
         BOOKINGS_TABLE: bookingsTable.tableName,
+        LOG_LEVEL: 'INFO', // Set to DEBUG to log full events
       },
       timeout: cdk.Duration.seconds(30),
       memorySize: 256,